@@ -1,38 +1,94 @@
+import argparse
+import contextlib
+import os
+import sqlite3
 import sys
 import time
 from typing import List
 
+from .cache import PersistentCostCache, get_default_cache_path, make_cache_context
 from .config import CLANG_FORMAT_CONFIG_FILE
 from .config import StyleSettings
 from .config import load_clang_format_config, save_clang_format_config
-from .execution import capture_process_output, ThreadPoolProcessDispatcher
-from .optimizer import optimize_configuration, minimize_configuration
+from .execution import capture_process_output, ProcessRunError
+from .execution import ExecutorProcessDispatcher, ProcessPoolProcessDispatcher, ThreadPoolProcessDispatcher
+from .optimizer import optimize_configuration, minimize_configuration, memoize_objective
 from .options import ALL_TUNEABLE_OPTIONS, PRIORITY_OPTIONS
-from .scoring import eval_clang_format_cost
-from .utils import search_files
+from .scoring import CostLimit, eval_clang_format_cost, measure_clang_format_times
+from .utils import group_identical_files, search_files
 
 
 CXX_EXTENSIONS = ['.cpp', '.cxx', '.cc', '.c', '.hpp', '.hxx', '.hh', '.h', '.ipp']
 FILE_BATCH_SIZE = 10
+FILE_BATCH_MAX = 100
 FILE_LIST_PRINT_MAX = 10
+# clang-format is CPU-bound - run one instance per core
+PROCESS_WORKERS = os.cpu_count() or 1
+if sys.platform == 'win32':
+    # ProcessPoolExecutor rejects more workers on Windows
+    PROCESS_WORKERS = min(PROCESS_WORKERS, 61)
 
 
-def verify_clang_version():
+def verify_clang_version() -> str:
     try:
         clang_version = capture_process_output(['clang-format', '--version'])
     except FileNotFoundError:
         sys.exit('clang-format not found!')
     if not clang_version.startswith('clang-format version 13.0.0'):
         sys.exit('clang-format version 13.0.0 is required')
+    return clang_version
+
+
+def choose_file_batch_size(file_list: List[str], config: StyleSettings) -> int:
+    if not file_list:
+        return FILE_BATCH_SIZE
+    sample_file = sorted(file_list, key=os.path.getsize)[len(file_list) // 2]
+    try:
+        startup_time, file_time = measure_clang_format_times(sample_file, config)
+    except ProcessRunError:
+        return FILE_BATCH_SIZE
+    # make batches big enough for the startup to take at most half of the time...
+    optimal_size = int(startup_time / file_time) if file_time > 0 else FILE_BATCH_MAX
+    # ...but keep enough of them for every worker to get one
+    balanced_size = -(-len(file_list) // PROCESS_WORKERS)
+    return max(1, min(optimal_size, balanced_size, FILE_BATCH_MAX))
+
+
+def make_process_dispatcher() -> ExecutorProcessDispatcher:
+    try:
+        return ProcessPoolProcessDispatcher(max_workers=PROCESS_WORKERS)
+    except (ImportError, NotImplementedError, OSError):
+        # multiprocessing is not fully supported on this platform
+        return ThreadPoolProcessDispatcher(max_workers=PROCESS_WORKERS)
+
+
+def open_cost_cache(clang_version: str, file_list: List[str], file_weights: List[int]):
+    cache_path = get_default_cache_path()
+    try:
+        return PersistentCostCache(cache_path, make_cache_context(clang_version, file_list, file_weights))
+    except (OSError, sqlite3.Error) as ex:
+        print(f'Cannot open cost cache {cache_path}: {ex}\n')
+        return contextlib.nullcontext()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Discovers the clang-format style that matches the existing code.')
+    parser.add_argument('paths', nargs='*', default=['.'], help='source files or directories to search')
+    parser.add_argument('--no-cache', action='store_true', help='do not reuse the costs from previous runs')
+    parser.add_argument('--restart-budget', type=int, default=0, metavar='N',
+        help='number of random changes of several options to try once no single option improves the style')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the random changes')
+    return parser.parse_args()
 
 
 def main():
-    verify_clang_version()
+    args = parse_args()
+    clang_version = verify_clang_version()
 
     try:
         baseline_config = load_clang_format_config()
     except FileNotFoundError:
-        baseline_config = StyleSettings({'Language':'Cpp'})
+        baseline_config = {'Language':'Cpp'}
         print(f'{CLANG_FORMAT_CONFIG_FILE} not found: will create it for you')
 
     current_config = baseline_config.copy()
@@ -42,28 +98,43 @@ def main():
         brace_wrapping_opts = filter(lambda k: k.startswith('BraceWrapping:'), ALL_TUNEABLE_OPTIONS)
         exclude_options.extend(brace_wrapping_opts)
 
-    search_roots = sys.argv[1:] if len(sys.argv) > 1 else ['.']
-    file_list = search_files(search_roots, CXX_EXTENSIONS)
+    file_list = search_files(args.paths, CXX_EXTENSIONS)
     print(f'Source files ({len(file_list)}): ', end='')
     if len(file_list) <= FILE_LIST_PRINT_MAX:
         print(' '.join(file_list), '\n')
     else:
         print(' '.join(file_list[:FILE_LIST_PRINT_MAX]), '(...)', '\n')
 
+    unique_files, file_weights = group_identical_files(file_list)
+    if len(unique_files) < len(file_list):
+        print(f'Found {len(file_list) - len(unique_files)} duplicate files: each will be formatted once\n')
+
+    file_batch_size = choose_file_batch_size(unique_files, current_config)
+    print(f'Processing files in batches of {file_batch_size}\n')
+
+    if args.no_cache:
+        cost_cache = contextlib.nullcontext()
+    else:
+        cost_cache = open_cost_cache(clang_version, unique_files, file_weights)
+
     t_start = time.monotonic()
     try:
-        with ThreadPoolProcessDispatcher(max_workers=5) as dispatcher:
-            def cost_func(config: StyleSettings) -> int:
+        with make_process_dispatcher() as dispatcher, cost_cache as cached_costs:
+            def eval_cost(config: StyleSettings, cost_limit: CostLimit) -> int:
                 return eval_clang_format_cost(
-                    file_list,
+                    unique_files,
                     dispatcher.map,
                     config=config,
-                    batch_max=FILE_BATCH_SIZE
+                    batch_max=file_batch_size,
+                    cost_limit=cost_limit,
+                    file_weights=file_weights
                 )
+            cost_func = memoize_objective(eval_cost, cached_costs)
             # start with most impactful options
             optimize_configuration(current_config, cost_func, include_opts=PRIORITY_OPTIONS, exclude_opts=exclude_options)
             # then continue with the rest
-            optimize_configuration(current_config, cost_func, exclude_opts=exclude_options)
+            optimize_configuration(current_config, cost_func, exclude_opts=exclude_options,
+                restart_budget=args.restart_budget, random_seed=args.seed)
             # finally remove any redundant settings
             minimize_configuration(current_config, cost_func, baseline_config.keys())
     except KeyboardInterrupt:
@@ -0,0 +1,160 @@
+import collections
+import collections.abc
+import hashlib
+import os
+import os.path
+import sqlite3
+import threading
+import time
+from typing import Iterator, List, Sequence, Tuple
+
+from .config import FrozenStyleSettings
+
+
+# (cost, is_exact) - inexact costs are lower bounds
+CachedCost = Tuple[int, bool]
+
+CACHE_CONTEXTS_MAX = 10
+# every entry holds a whole style - a few kilobytes
+MEMORY_CACHE_MAX = 4096
+
+
+def get_default_cache_path() -> str:
+    cache_root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_root, 'clang-format-discover', 'costs.sqlite')
+
+
+def make_cache_context(clang_version: str, file_list: List[str], file_weights: Sequence[int]) -> str:
+    """Returns a digest of everything besides the style that the costs depend on."""
+    context_hash = hashlib.sha256(clang_version.encode())
+    file_digests = []
+    for path, weight in zip(file_list, file_weights):
+        with open(path, 'rb') as file:
+            file_digests.append(f'{os.path.basename(path)}:{hashlib.sha1(file.read()).hexdigest()}:{weight}')
+    for file_digest in sorted(file_digests):
+        context_hash.update(file_digest.encode())
+    return context_hash.hexdigest()
+
+
+class LruCostCache(collections.abc.MutableMapping):
+    """Costs of style configs kept in memory, dropping the least recently used ones."""
+    _entries: 'collections.OrderedDict[FrozenStyleSettings, CachedCost]'
+    _maxsize: int
+    _lock: threading.Lock
+
+    def __init__(self, maxsize: int = MEMORY_CACHE_MAX) -> None:
+        self._entries = collections.OrderedDict()
+        self._maxsize = maxsize
+        # the cache is shared by the threads evaluating candidate values
+        self._lock = threading.Lock()
+
+    def __getitem__(self, frozen_config: FrozenStyleSettings) -> CachedCost:
+        with self._lock:
+            self._entries.move_to_end(frozen_config)
+            return self._entries[frozen_config]
+
+    def __setitem__(self, frozen_config: FrozenStyleSettings, cached_cost: CachedCost):
+        with self._lock:
+            self._entries[frozen_config] = cached_cost
+            self._entries.move_to_end(frozen_config)
+            if len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def __delitem__(self, frozen_config: FrozenStyleSettings):
+        with self._lock:
+            del self._entries[frozen_config]
+
+    def __iter__(self) -> Iterator[FrozenStyleSettings]:
+        with self._lock:
+            return iter(list(self._entries))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class PersistentCostCache(collections.abc.MutableMapping):
+    """Costs of style configs, stored on disk across runs. Costs recorded for other
+    contexts (e.g. after the sources have changed) are not visible."""
+    _connection: sqlite3.Connection
+    _context: str
+    _lock: threading.Lock
+
+    def __init__(self, path: str, context: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the cache is shared by the threads evaluating candidate values, and may be shared
+        # by concurrent runs - commit every write, so that the write lock is never held for long
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._context = context
+        self._lock = threading.Lock()
+        try:
+            # lets readers proceed while another run writes
+            self._connection.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.Error:
+            pass
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS contexts (context TEXT PRIMARY KEY, last_used REAL)')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS costs (context TEXT, config TEXT, cost INTEGER, exact INTEGER,'
+                ' PRIMARY KEY (context, config))')
+            self._connection.execute(
+                'INSERT OR REPLACE INTO contexts VALUES (?, ?)', (context, time.time()))
+            # forget the least recently used contexts
+            self._connection.execute(
+                'DELETE FROM contexts WHERE context NOT IN'
+                ' (SELECT context FROM contexts ORDER BY last_used DESC LIMIT ?)', (CACHE_CONTEXTS_MAX,))
+            self._connection.execute(
+                'DELETE FROM costs WHERE context NOT IN (SELECT context FROM contexts)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __getitem__(self, frozen_config: FrozenStyleSettings) -> CachedCost:
+        try:
+            with self._lock:
+                row = self._connection.execute(
+                    'SELECT cost, exact FROM costs WHERE context = ? AND config = ?',
+                    (self._context, frozen_config)).fetchone()
+        except sqlite3.Error:
+            # e.g. locked by another run - evaluate the cost again
+            row = None
+        if row is None:
+            raise KeyError(frozen_config)
+        return row[0], bool(row[1])
+
+    def __setitem__(self, frozen_config: FrozenStyleSettings, cached_cost: CachedCost):
+        cost, is_exact = cached_cost
+        try:
+            with self._lock:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO costs VALUES (?, ?, ?, ?)',
+                    (self._context, frozen_config, cost, int(is_exact)))
+        except sqlite3.Error:
+            # losing an entry only costs a re-evaluation in a later run
+            pass
+
+    def __delitem__(self, frozen_config: FrozenStyleSettings):
+        with self._lock:
+            cursor = self._connection.execute(
+                'DELETE FROM costs WHERE context = ? AND config = ?', (self._context, frozen_config))
+        if cursor.rowcount == 0:
+            raise KeyError(frozen_config)
+
+    def __iter__(self) -> Iterator[FrozenStyleSettings]:
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT config FROM costs WHERE context = ?', (self._context,)).fetchall()
+        return (row[0] for row in rows)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM costs WHERE context = ?', (self._context,)).fetchone()[0]
@@ -1,7 +1,6 @@
 import json
-from typing import TextIO, Union
+from typing import Any, Dict, TextIO, Union
 
-import flatdict
 import yaml
 
 from .execution import capture_process_output
@@ -9,10 +8,41 @@ from .execution import capture_process_output
 
 CLANG_FORMAT_CONFIG_FILE = '.clang-format'
 
-StyleSettings = flatdict.FlatDict
+# use libyaml bindings when PyYAML has been built with them
+try:
+    from yaml import CSafeLoader as _SafeLoader, CSafeDumper as _SafeDumper
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader, SafeDumper as _SafeDumper
 
+# style options keyed by flat names - nested options are joined with ':',
+# e.g. 'BraceWrapping:AfterClass'
+StyleSettings = Dict[str, Any]
+FrozenStyleSettings = str
+STYLE_KEY_DELIMITER = ':'
 
-class ClangFormatLoader(yaml.SafeLoader):
+
+def flatten_style_settings(nested: Dict[str, Any], prefix: str = '') -> StyleSettings:
+    config: StyleSettings = {}
+    for key, value in nested.items():
+        if isinstance(value, dict):
+            config.update(flatten_style_settings(value, prefix + key + STYLE_KEY_DELIMITER))
+        else:
+            config[prefix + key] = value
+    return config
+
+
+def nest_style_settings(config: StyleSettings) -> Dict[str, Any]:
+    nested: Dict[str, Any] = {}
+    for key, value in config.items():
+        *parents, name = key.split(STYLE_KEY_DELIMITER)
+        parent = nested
+        for parent_key in parents:
+            parent = parent.setdefault(parent_key, {})
+        parent[name] = value
+    return nested
+
+
+class ClangFormatLoader(_SafeLoader):
     # reset implicit type handlers - treat all scalars as strings
     yaml_implicit_resolvers = {}
 
@@ -20,23 +50,32 @@ def load_clang_format_config(file: Union[TextIO, str, None] = None) -> StyleSett
     if file is None:
         with open(CLANG_FORMAT_CONFIG_FILE, 'r', encoding='utf-8') as f:
             return load_clang_format_config(f)
-    return StyleSettings(yaml.load(file, Loader=ClangFormatLoader))
+    return flatten_style_settings(yaml.load(file, Loader=ClangFormatLoader) or {})
 
 
-class ClangFormatDumper(yaml.SafeDumper):
+class ClangFormatDumper(_SafeDumper):
     # reset implicit type handlers - treat all scalars as strings
     yaml_implicit_resolvers = {}
 
 def save_clang_format_config(config: StyleSettings):
     with open(CLANG_FORMAT_CONFIG_FILE, 'w', encoding='utf-8') as file:
-        yaml.dump(config.as_dict(), file, Dumper=ClangFormatDumper,
+        yaml.dump(nest_style_settings(config), file, Dumper=ClangFormatDumper,
             explicit_start=True, explicit_end=True,
             sort_keys=False
         )
 
 
+def freeze_clang_format_config(config: StyleSettings) -> FrozenStyleSettings:
+    # values may be lists (e.g. IncludeCategories) - use a canonical string
+    return json.dumps(config, sort_keys=True)
+
+
+def thaw_clang_format_config(frozen_config: FrozenStyleSettings) -> StyleSettings:
+    return json.loads(frozen_config)
+
+
 def inline_clang_format_config(config: StyleSettings) -> str:
-    return json.dumps(config.as_dict())
+    return json.dumps(nest_style_settings(config), separators=(',', ': '))
 
 
 def get_effective_clang_format_config(config: StyleSettings) -> StyleSettings:
@@ -1,31 +1,93 @@
 import concurrent.futures
+import functools
+import os
+import shutil
+import signal
 import subprocess
-from typing import Iterable, List
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, TypeVar
+
+_T = TypeVar('T')
+
+OUTPUT_CHUNK_SIZE = 65536
+# subprocess only uses posix_spawn instead of fork without close_fds (Python's own
+# descriptors are not inheritable anyway). Elsewhere, keep concurrently started
+# children from inheriting each other's pipe handles.
+CLOSE_FDS = os.name != 'posix'
 
 
 class ProcessRunError(Exception):
     def __init__(self, returncode: int, stderr: str) -> None:
+        # pass the fields on, so that the error can be pickled by process pools
+        super().__init__(returncode, stderr)
         self.returncode = returncode
         self.stderr = stderr
 
 
 def capture_process_output(args: List[str], timeout: int=10) -> str:
+    return capture_process_binary_output(args, timeout).decode()
+
+
+def capture_process_binary_output(args: List[str], timeout: int=10) -> bytes:
     try:
         return subprocess.run(
-            args,
+            spawnable_args(args),
             check=True,
-            capture_output=True, text=True,
-            timeout=timeout
+            capture_output=True,
+            timeout=timeout,
+            close_fds=CLOSE_FDS
         ).stdout
     except subprocess.CalledProcessError as ex:
-        raise ProcessRunError(ex.returncode, ex.stderr) from ex
+        raise ProcessRunError(ex.returncode, ex.stderr.decode(errors='replace')) from ex
+
+
+def stream_process_binary_output(args: List[str], timeout: int=10) -> Iterator[bytes]:
+    """Yields the output of the process as it arrives. Closing the generator early kills the process."""
+    with subprocess.Popen(spawnable_args(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=CLOSE_FDS) as process:
+        # reads block - enforce the timeout by killing the process instead
+        timed_out = threading.Event()
+        def kill_on_timeout():
+            timed_out.set()
+            process.kill()
+        timer = threading.Timer(timeout, kill_on_timeout)
+        timer.start()
+        # drain stderr alongside, so that the process never blocks on a full pipe
+        stderr_chunks: List[bytes] = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()))
+        stderr_reader.start()
+        try:
+            while True:
+                chunk = process.stdout.read1(OUTPUT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            process.wait()
+        finally:
+            timer.cancel()
+            if process.poll() is None:
+                process.kill()
+            stderr_reader.join()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(args, timeout)
+    if process.returncode != 0:
+        raise ProcessRunError(process.returncode, b''.join(stderr_chunks).decode(errors='replace'))
+
+
+def spawnable_args(args: List[str]) -> List[str]:
+    # subprocess only uses posix_spawn for absolute executable paths
+    return [resolve_executable(args[0]), *args[1:]]
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_executable(name: str) -> str:
+    return shutil.which(name) or name
 
 
-class ThreadPoolProcessDispatcher(object):
+class ExecutorProcessDispatcher(object):
     _executor: concurrent.futures.Executor
 
-    def __init__(self, max_workers:int=5) -> None:
-        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    def __init__(self, executor: concurrent.futures.Executor) -> None:
+        self._executor = executor
 
     def __enter__(self):
         self._executor.__enter__()
@@ -34,7 +96,26 @@ class ThreadPoolProcessDispatcher(object):
     def __exit__(self, *exc):
         return self._executor.__exit__(*exc)
 
-    def map(self, args_list: Iterable[List[str]]) -> Iterable[Iterable[str]]:
-        def dispatch_one(args: List[str]) -> Iterable[str]:
-            return capture_process_output(args).splitlines()
-        return self._executor.map(dispatch_one, args_list)
+    def map(self, fn: Callable[..., _T], *iterables: Iterable[Any]) -> Iterator[_T]:
+        return self._executor.map(fn, *iterables)
+
+
+class ThreadPoolProcessDispatcher(ExecutorProcessDispatcher):
+    def __init__(self, max_workers:int=5) -> None:
+        super().__init__(concurrent.futures.ThreadPoolExecutor(max_workers=max_workers))
+
+
+class ProcessPoolProcessDispatcher(ExecutorProcessDispatcher):
+    """Runs the jobs in worker processes, so that processing their output is not limited by the GIL.
+    Jobs and their arguments must be picklable."""
+
+    def __init__(self, max_workers:int=5) -> None:
+        super().__init__(concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_ignore_keyboard_interrupt
+        ))
+
+
+def _ignore_keyboard_interrupt():
+    # Ctrl+C is handled by the main process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
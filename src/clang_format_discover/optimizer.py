@@ -1,26 +1,125 @@
-import itertools
+import collections
+import collections.abc
+import concurrent.futures
+import functools
+import math
+import operator
+import random
 import sys
-from typing import Callable, Dict, Iterable, List, Optional, Set
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
-from .config import StyleSettings
+from .cache import LruCostCache
+from .config import FrozenStyleSettings, StyleSettings
+from .config import freeze_clang_format_config, thaw_clang_format_config
 from .config import get_effective_clang_format_config
 from .execution import ProcessRunError
-from .options import ALL_TUNEABLE_OPTIONS
+from .options import ALL_TUNEABLE_OPTIONS, get_related_options
+from .scoring import CostLimit, get_cost_limit
 from .utils import ordered_diff
 
-StyleObjectiveFun = Callable[[StyleSettings], int]
+# Objective functions take an optional cost limit. Once the cost is known to exceed
+# the limit, they may stop early and return any lower bound that is above the limit.
+# A callable limit may only decrease over time.
+StyleObjectiveFun = Callable[[StyleSettings, CostLimit], int]
 ValueCostMap = Dict[str, int]
 
+PROGRESS_FLUSH_INTERVAL = 0.1
+
+# number of options changed at once when trying to escape a local optimum
+PERTURBATION_SIZE_MIN = 2
+PERTURBATION_SIZE_MAX = 3
+
+
+class CostBound(object):
+    """Cost limit shared by concurrent evaluations, lowered to the best cost found so far."""
+    _limit: int
+    _lock: threading.Lock
+
+    def __init__(self, limit: int) -> None:
+        self._limit = limit
+        self._lock = threading.Lock()
+
+    def __call__(self) -> int:
+        return self._limit
+
+    def lower(self, cost: int):
+        with self._lock:
+            self._limit = min(self._limit, cost)
+
+
+class ProgressPrinter(object):
+    """Prints a mark for every step on one line, writing them out at most every PROGRESS_FLUSH_INTERVAL."""
+    _pending_marks: str = ''
+    _last_flush: float = 0.0
+    _line_started: bool = False
+
+    def step(self, mark: str = '.'):
+        self._pending_marks += mark
+        if time.monotonic() - self._last_flush >= PROGRESS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self._pending_marks:
+            print(self._pending_marks, end='', flush=True)
+            self._pending_marks = ''
+            self._line_started = True
+        self._last_flush = time.monotonic()
+
+    def end_line(self):
+        self.flush()
+        if self._line_started:
+            print()
+            self._line_started = False
+
+
+def memoize_objective(
+        cost_fun: StyleObjectiveFun,
+        cache: Optional[collections.abc.MutableMapping] = None
+        ) -> StyleObjectiveFun:
+    # maps configs to (cost, is_exact) - inexact costs are lower bounds
+    if cache is None:
+        cache = LruCostCache()
+    # configs rejected by clang-format fail the same way every time
+    errors: Dict[FrozenStyleSettings, ProcessRunError] = {}
+    def cached_cost_fun(config: StyleSettings, cost_limit: CostLimit) -> int:
+        frozen_config = freeze_clang_format_config(config)
+        if frozen_config in errors:
+            cached_error = errors[frozen_config]
+            raise ProcessRunError(cached_error.returncode, cached_error.stderr)
+        cached_cost: Optional[Tuple[int, bool]] = cache.get(frozen_config)
+        if cached_cost is not None:
+            cost, is_exact = cached_cost
+            current_limit = get_cost_limit(cost_limit)
+            if is_exact or (current_limit is not None and cost > current_limit):
+                return cost
+        try:
+            cost = cost_fun(config, cost_limit)
+        except ProcessRunError as ex:
+            errors[frozen_config] = ex
+            raise
+        # the evaluation stopped early only if the cost exceeds the final limit
+        final_limit = get_cost_limit(cost_limit)
+        cache[frozen_config] = (cost, final_limit is None or cost <= final_limit)
+        return cost
+    return cached_cost_fun
+
 
 def get_safe_option_values(key: str, current_config: StyleSettings) -> List[str]:
-    safe_values = ALL_TUNEABLE_OPTIONS[key]
-    if key in ['BinPackParameters', 'InsertTrailingCommas']:
-        effective_config = get_effective_clang_format_config(current_config)
-        safe_values = safe_values.copy()
-        if key == 'InsertTrailingCommas' and effective_config['BinPackParameters'] == 'true':
-            safe_values.remove('Wrapped')
-        elif key == 'BinPackParameters' and effective_config['InsertTrailingCommas'] == 'Wrapped':
-            safe_values.remove('true')
+    if key not in ['BinPackParameters', 'InsertTrailingCommas']:
+        return ALL_TUNEABLE_OPTIONS[key]
+    return get_safe_coupled_option_values(key, freeze_clang_format_config(current_config))
+
+
+@functools.lru_cache(maxsize=1024)
+def get_safe_coupled_option_values(key: str, frozen_config: FrozenStyleSettings) -> List[str]:
+    effective_config = get_effective_clang_format_config(thaw_clang_format_config(frozen_config))
+    safe_values = ALL_TUNEABLE_OPTIONS[key].copy()
+    if key == 'InsertTrailingCommas' and effective_config['BinPackParameters'] == 'true':
+        safe_values.remove('Wrapped')
+    elif key == 'BinPackParameters' and effective_config['InsertTrailingCommas'] == 'Wrapped':
+        safe_values.remove('true')
     return safe_values
 
 
@@ -28,24 +127,58 @@ def evaluate_option_values(
         baseline: StyleSettings,
         key: str,
         cost_fun: StyleObjectiveFun,
-        include_current: bool = True
-    ) -> ValueCostMap:
+        include_current: bool = True,
+        cost_limit: Optional[int] = None,
+        previous_costs: Optional[ValueCostMap] = None
+    ) -> Tuple[ValueCostMap, ValueCostMap]:
+    """Returns the costs of the candidate values, and the limits exceeded by the ones
+    that have only been evaluated partially. Values that cannot beat the best cost
+    found so far are not evaluated exactly."""
+    candidate_values = get_safe_option_values(key, baseline)
+    if not include_current:
+        # skip baseline cost calculation
+        candidate_values = [val for val in candidate_values if baseline.get(key) != val]
+    if not candidate_values:
+        return {}, {}
+    evaluation_order = candidate_values
+    if previous_costs:
+        # start with the values that did best before, so that the bound drops quickly
+        evaluation_order = sorted(candidate_values, key=lambda val: previous_costs.get(val, math.inf))
+
+    cost_bound = None if cost_limit is None else CostBound(cost_limit)
+    exceeded_limits: ValueCostMap = {}
+    def eval_value_cost(val: str) -> int:
+        config = baseline.copy()
+        config[key] = val
+        cost = cost_fun(config, cost_bound)
+        if cost_bound is not None:
+            if cost > cost_bound():
+                exceeded_limits[val] = cost_bound()
+            cost_bound.lower(cost)
+        return cost
+
+    # candidates are independent - evaluate them concurrently
     costs: ValueCostMap = {}
-    for val in get_safe_option_values(key, baseline):
-        if not include_current and baseline.get(key) == val:
-            continue # skip baseline cost calculation
-        try:
-            config = baseline.copy()
-            config[key] = val
-            costs[val] = cost_fun(config)
-        except ProcessRunError as ex:
-            print('\nclang-format error:\n', ex.stderr, sep='', file=sys.stderr)
-    return costs
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(candidate_values)) as executor:
+        futures = {val: executor.submit(eval_value_cost, val) for val in evaluation_order}
+        # keep the candidates' order, which decides between equal costs
+        for val in candidate_values:
+            try:
+                costs[val] = futures[val].result()
+            except ProcessRunError as ex:
+                print('\nclang-format error:\n', ex.stderr, sep='', file=sys.stderr)
+    return costs, exceeded_limits
 
 
-def costs_to_string(costs: ValueCostMap) -> str:
-    sorted_costs = sorted(costs.items(), key=lambda kv: kv[1])
-    formatted_costs = [f'{val}:{cost}' for val, cost in sorted_costs]
+def costs_to_string(costs: ValueCostMap, exceeded_limits: Optional[ValueCostMap] = None) -> str:
+    if exceeded_limits is None:
+        exceeded_limits = {}
+    def format_cost(val: str, cost: int) -> str:
+        if val in exceeded_limits:
+            return f'>{exceeded_limits[val]}'
+        return str(cost)
+    sorted_costs = sorted(costs.items(), key=operator.itemgetter(1))
+    formatted_costs = [f'{val}:{format_cost(val, cost)}' for val, cost in sorted_costs]
     return '{' + ' '.join(formatted_costs) + '}'
 
 
@@ -53,8 +186,13 @@ def optimize_configuration(
         rw_config: StyleSettings,
         cost_fun: StyleObjectiveFun,
         include_opts: Optional[Iterable[str]] = None,
-        exclude_opts: Optional[Iterable[str]] = None
+        exclude_opts: Optional[Iterable[str]] = None,
+        restart_budget: int = 0,
+        random_seed: int = 0
         ):
+    """Changes one option at a time for as long as the cost improves. Then tries up to
+    restart_budget random changes of several options at once, resuming the search
+    from any that improves the cost."""
     if include_opts is None:
         include_opts = ALL_TUNEABLE_OPTIONS.keys()
     if exclude_opts is None:
@@ -63,30 +201,94 @@ def optimize_configuration(
     if not tuneable_options:
         return
 
-    current_cost = cost_fun(rw_config)
-    visited_keys: Set[str] = set()
+    current_cost = cost_fun(rw_config, None)
+    # cost reduction most recently achieved by each key
+    impact: Dict[str, int] = {}
+    # costs of each key's values when it was last checked
+    value_costs: Dict[str, ValueCostMap] = {}
+    # spread of those costs - keys that made no difference are re-checked last
+    sensitivity: Dict[str, float] = {}
+    pending_keys = collections.deque(tuneable_options)
+    rng = random.Random(random_seed)
+    progress = ProgressPrinter()
     print(f'Trying to optimize {len(tuneable_options)} variables...')
-    for key in itertools.cycle(tuneable_options):
-        if key in visited_keys:
-            break
-        all_costs = evaluate_option_values(rw_config, key, cost_fun, include_current=False)
+    # no option can do better once the code matches the style exactly
+    while current_cost > 0:
+        if not pending_keys:
+            if restart_budget <= 0:
+                break
+            restart_budget -= 1
+            perturbed_config, perturbed_cost = perturb_configuration(rw_config, tuneable_options, cost_fun, current_cost, rng)
+            if perturbed_cost < current_cost:
+                progress.end_line()
+                changes = [f'{k}={v}' for k, v in perturbed_config.items() if rw_config.get(k) != v]
+                print(f'Set {" ".join(changes)} cost {current_cost}=>{perturbed_cost}')
+                rw_config.update(perturbed_config)
+                current_cost = perturbed_cost
+                pending_keys = collections.deque(tuneable_options)
+            else:
+                progress.step('~')
+            continue
+
+        key = pending_keys.popleft()
+        # candidates worse than the current cost are never chosen - stop scoring them early
+        all_costs, exceeded_limits = evaluate_option_values(
+            rw_config, key, cost_fun,
+            include_current=False,
+            cost_limit=current_cost,
+            previous_costs=value_costs.get(key)
+        )
+        value_costs[key] = all_costs.copy()
         if key in rw_config:
             all_costs[rw_config[key]] = current_cost
-        best_val, best_cost = min(all_costs.items(), key=lambda kv: kv[1])
+        best_val, best_cost = min(all_costs.items(), key=operator.itemgetter(1))
+        # pruned costs are lower bounds above the exact minimum, so the spread
+        # between them is still a lower bound of the true spread
+        exact_costs = [cost for val, cost in all_costs.items() if val not in exceeded_limits]
+        sensitivity[key] = max(all_costs.values()) - min(exact_costs, default=current_cost)
 
         if best_cost < current_cost:
-            if len(visited_keys) > 1:
-                print()
-            print(f'Set {key}={best_val} cost {current_cost}=>{best_cost} {costs_to_string(all_costs)}')
+            progress.end_line()
+            print(f'Set {key}={best_val} cost {current_cost}=>{best_cost} {costs_to_string(all_costs, exceeded_limits)}')
             rw_config[key] = best_val
+            impact[key] = current_cost - best_cost
             current_cost = best_cost
-            visited_keys.clear()
+            # re-check all the other keys, starting with the related and most impactful ones,
+            # then the ones that made the most difference (or have not been checked yet)
+            related_keys = get_related_options(key)
+            key_index = tuneable_options.index(key)
+            next_keys = tuneable_options[key_index+1:] + tuneable_options[:key_index]
+            pending_keys = collections.deque(sorted(next_keys, key=lambda k: (
+                k not in related_keys,
+                -impact.get(k, 0),
+                -sensitivity.get(k, math.inf)
+            )))
         else:
-            print('.', end='', flush=True)
-        visited_keys.add(key)
+            progress.step('.')
+    progress.flush()
     print('\nDone!\n')
 
 
+def perturb_configuration(
+        baseline: StyleSettings,
+        tuneable_options: List[str],
+        cost_fun: StyleObjectiveFun,
+        cost_limit: int,
+        rng: random.Random
+        ) -> Tuple[StyleSettings, float]:
+    """Returns a copy of the baseline with a few options set to random values, and its cost."""
+    config = baseline.copy()
+    num_keys = min(len(tuneable_options), rng.randint(PERTURBATION_SIZE_MIN, PERTURBATION_SIZE_MAX))
+    try:
+        for key in rng.sample(tuneable_options, num_keys):
+            # probe the unperturbed baseline - the perturbed config may already be invalid
+            config[key] = rng.choice(get_safe_option_values(key, baseline))
+        return config, cost_fun(config, cost_limit)
+    except ProcessRunError:
+        # e.g. options incompatible with each other
+        return config, math.inf
+
+
 def minimize_configuration(
         rw_config: StyleSettings,
         cost_fun: StyleObjectiveFun,
@@ -96,34 +298,33 @@ def minimize_configuration(
     if not tuneable_keys:
         return
 
-    def evaluate_default_value(baseline: StyleSettings, key: str) -> int:
+    def evaluate_default_value(baseline: StyleSettings, key: str, cost_limit: int) -> int:
         config = baseline.copy()
         del config[key]
-        return cost_fun(config)
+        return cost_fun(config, cost_limit)
 
-    current_cost = cost_fun(rw_config)
-    visited_keys: Set[str] = set()
+    current_cost = cost_fun(rw_config, None)
+    pending_keys = collections.deque(tuneable_keys)
+    progress = ProgressPrinter()
     print('Trying to minimize the configuration...')
-    for key in itertools.cycle(tuneable_keys):
-        if key in visited_keys:
-            break
-
+    while pending_keys:
+        key = pending_keys.popleft()
         try:
-            new_cost = evaluate_default_value(rw_config, key)
-        except KeyError:
-            continue
+            new_cost = evaluate_default_value(rw_config, key, current_cost)
         except ProcessRunError as ex:
             print('\nclang-format error:\n', ex.stderr, sep='', file=sys.stderr)
             continue
 
         if new_cost <= current_cost:
-            if len(visited_keys) > 1:
-                print()
+            progress.end_line()
             print(f'Removed {key} cost {current_cost} => {new_cost}')
             del rw_config[key]
             current_cost = new_cost
-            visited_keys.clear()
+            # re-check the keys that are still set
+            key_index = tuneable_keys.index(key)
+            next_keys = tuneable_keys[key_index+1:] + tuneable_keys[:key_index]
+            pending_keys = collections.deque(k for k in next_keys if k in rw_config)
         else:
-            print('.', end='', flush=True)
-        visited_keys.add(key)
+            progress.step('.')
+    progress.flush()
     print('\nDone!\n')
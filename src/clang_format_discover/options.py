@@ -1,3 +1,5 @@
+from typing import Set
+
 BOOLEAN_OPTION_TYPE = ['false', 'true']
 
 # Extracted from the documentation of clang-format version 13
@@ -121,3 +123,43 @@ ALL_TUNEABLE_OPTIONS = {
 }
 
 PRIORITY_OPTIONS = ['IndentWidth', 'UseTab', 'SortIncludes', 'IncludeBlocks']
+
+# Options that interact with each other - a change of one of them is likely to make
+# the others worth changing too
+RELATED_OPTION_GROUPS = [
+    ['IndentWidth', 'UseTab', 'ContinuationIndentWidth', 'ConstructorInitializerIndentWidth'],
+    ['IndentWidth', 'AccessModifierOffset', 'IndentAccessModifiers', 'NamespaceIndentation'],
+    ['ColumnLimit', 'PenaltyExcessCharacter', 'PenaltyBreakAssignment', 'PenaltyBreakBeforeFirstCallParameter',
+        'PenaltyReturnTypeOnItsOwnLine', 'BreakStringLiterals', 'ReflowComments'],
+    ['ColumnLimit', 'AlignAfterOpenBracket', 'BinPackArguments', 'BinPackParameters',
+        'AllowAllArgumentsOnNextLine', 'AllowAllParametersOfDeclarationOnNextLine'],
+    ['BinPackParameters', 'InsertTrailingCommas'],
+    ['PointerAlignment', 'ReferenceAlignment', 'SpaceAroundPointerQualifiers'],
+    ['AlignConsecutiveAssignments', 'AlignConsecutiveBitFields', 'AlignConsecutiveDeclarations',
+        'AlignConsecutiveMacros', 'AlignTrailingComments'],
+    ['BreakConstructorInitializers', 'BreakConstructorInitializersBeforeComma', 'ConstructorInitializerIndentWidth',
+        'ConstructorInitializerAllOnOneLineOrOnePerLine', 'AllowAllConstructorInitializersOnNextLine',
+        'SpaceBeforeCtorInitializerColon'],
+    ['BreakInheritanceList', 'BreakBeforeInheritanceComma', 'SpaceBeforeInheritanceColon'],
+    ['AllowShortFunctionsOnASingleLine', 'BraceWrapping:AfterFunction', 'BraceWrapping:SplitEmptyFunction'],
+    ['AllowShortBlocksOnASingleLine', 'AllowShortIfStatementsOnASingleLine', 'AllowShortLoopsOnASingleLine',
+        'SpaceInEmptyBlock'],
+    ['AllowShortCaseLabelsOnASingleLine', 'IndentCaseLabels', 'IndentCaseBlocks', 'BraceWrapping:AfterCaseLabel'],
+    ['AllowShortEnumsOnASingleLine', 'BraceWrapping:AfterEnum'],
+    ['AllowShortLambdasOnASingleLine', 'BraceWrapping:BeforeLambdaBody', 'LambdaBodyIndentation'],
+    ['AlwaysBreakAfterReturnType', 'AlwaysBreakAfterDefinitionReturnType', 'PenaltyReturnTypeOnItsOwnLine',
+        'IndentWrappedFunctionNames'],
+    ['NamespaceIndentation', 'CompactNamespaces', 'FixNamespaceComments', 'ShortNamespaceLines'],
+    ['EmptyLineBeforeAccessModifier', 'EmptyLineAfterAccessModifier', 'KeepEmptyLinesAtTheStartOfBlocks',
+        'MaxEmptyLinesToKeep'],
+    ['SortIncludes', 'IncludeBlocks'],
+    ['Cpp11BracedListStyle', 'SpaceBeforeCpp11BracedList', 'SpacesInContainerLiterals'],
+    ['SpacesInLineCommentPrefix:Minimum', 'SpacesInLineCommentPrefix:Maximum', 'SpacesBeforeTrailingComments'],
+    ['SpacesInParentheses', 'SpacesInConditionalStatement', 'SpacesInCStyleCastParentheses',
+        'SpaceInEmptyParentheses'],
+    ['Standard', 'SpacesInAngles'],
+]
+
+
+def get_related_options(key: str) -> Set[str]:
+    return {k for group in RELATED_OPTION_GROUPS if key in group for k in group if k != key}
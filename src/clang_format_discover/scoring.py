@@ -1,22 +1,47 @@
-import xml.sax
-import xml.sax.handler
-from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import functools
+import html
+import itertools
+import math
+import os
+import re
+import time
+from typing import Callable, Generator, Iterable, List, Optional, Sequence, Tuple, Union
 
 from .config import StyleSettings, inline_clang_format_config
-from .utils import chunkify
+from .execution import capture_process_binary_output, stream_process_binary_output
 
 
 ProcessArgsList = List[str]
-LineIterable = Iterable[str]
-ProcessDispatcher = Callable[[Iterable[ProcessArgsList]], Iterable[LineIterable]]
+# a fixed limit, or one that may be lowered while the cost is being evaluated
+CostLimit = Union[int, Callable[[], int], None]
+FileWeights = Optional[Sequence[int]]
+BatchCostFun = Callable[[ProcessArgsList, FileWeights, Optional[int]], int]
+# executor-like map over clang-format jobs: (job, args_list, weights_list, limits_list) -> costs
+ProcessDispatcher = Callable[
+    [BatchCostFun, Iterable[ProcessArgsList], Iterable[FileWeights], Iterable[Optional[int]]],
+    Iterable[int]
+]
+
+# clang-format emits one <replacement> element per line, with special characters
+# of the inserted text escaped as XML entities (e.g. newlines as &#10;)
+REPLACEMENT_PATTERN = re.compile(rb"<replacement [^>]*length='(\d+)'[^>]*>([^<]*)</replacement>")
+# every file gets a separate XML document
+XML_DOCUMENT_PREFIX = b'<?xml '
+# CreateProcess limit, for platforms without sysconf
+COMMAND_LINE_MAX_DEFAULT = 32767
 
 
 def eval_clang_format_cost(
         file_list: List[str],
         dispatcher: ProcessDispatcher,
         config: Optional[StyleSettings] = None,
-        batch_max: int = 10
+        batch_max: int = 10,
+        cost_limit: CostLimit = None,
+        file_weights: FileWeights = None
         ) -> int:
+    """Returns the cost of reformatting the files, or once it exceeds cost_limit,
+    a partial cost that is already above the limit. The cost of each file is
+    multiplied by its weight, if given."""
     if config is None:
         style_arg = '--style=file'
     else:
@@ -24,45 +49,138 @@ def eval_clang_format_cost(
     def make_clang_format_args(files: Iterable[str]) -> List[str]:
         return ['clang-format', '--output-replacements-xml', style_arg, *files]
 
-    handler = ReplacementsXmlHandler()
-    parser = xml.sax.make_parser(['xml.sax.IncrementalParser'])
-    parser.setContentHandler(handler)
+    batch_bounds = split_file_batches(file_list, batch_max, get_command_line_max() - len(style_arg))
+    file_list_chunks = [file_list[i:j] for i, j in batch_bounds]
+    if file_weights is None:
+        weights_chunks: Iterable[FileWeights] = itertools.repeat(None)
+    else:
+        weights_chunks = [file_weights[i:j] for i, j in batch_bounds]
+    # a single batch above the limit is enough to exceed it
+    batch_limits = itertools.repeat(get_cost_limit(cost_limit))
+    total_cost = 0
+    # leaving the loop early cancels the batches that have not started yet
+    batch_args = map(make_clang_format_args, file_list_chunks)
+    for batch_cost in dispatcher(eval_batch_cost, batch_args, weights_chunks, batch_limits):
+        total_cost += batch_cost
+        current_limit = get_cost_limit(cost_limit)
+        if current_limit is not None and total_cost > current_limit:
+            break
+    return total_cost
+
+
+def get_cost_limit(cost_limit: CostLimit) -> Optional[int]:
+    return cost_limit() if callable(cost_limit) else cost_limit
+
 
-    file_list_chunks = chunkify(file_list, batch_max)
-    for output_xml in dispatcher(map(make_clang_format_args, file_list_chunks)):
-        for line in output_xml:
-            if line.startswith("<?xml version='1.0'?>"):
-                parser.close()
-                parser.reset()
-            parser.feed(line)
+def split_file_batches(file_list: List[str], batch_max: int, args_len_max: int) -> List[Tuple[int, int]]:
+    """Returns the bounds of consecutive batches of at most batch_max files,
+    whose names fit in args_len_max characters of the command line."""
+    batch_bounds: List[Tuple[int, int]] = []
+    batch_start = 0
+    args_len = 0
+    for i, path in enumerate(file_list):
+        # count the separators and terminators too
+        path_len = len(os.fsencode(path)) + 1
+        if i > batch_start and (i - batch_start >= batch_max or args_len + path_len > args_len_max):
+            batch_bounds.append((batch_start, i))
+            batch_start = i
+            args_len = 0
+        args_len += path_len
+    if batch_start < len(file_list):
+        batch_bounds.append((batch_start, len(file_list)))
+    return batch_bounds
 
-    return handler.get_total_cost()
 
+@functools.lru_cache(maxsize=1)
+def get_command_line_max() -> int:
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        arg_max = COMMAND_LINE_MAX_DEFAULT
+    if arg_max <= 0:
+        arg_max = COMMAND_LINE_MAX_DEFAULT
+    # the environment and the fixed arguments share the same space
+    return arg_max // 2
 
-class ReplacementsXmlHandler(xml.sax.handler.ContentHandler):
-    _started: bool = False
-    _num_remove: int
-    _num_insert: int
-    _replacements: List[Tuple[int, int]]
 
-    def __init__(self) -> None:
-        super().__init__()
-        self._replacements = []
+def eval_batch_cost(args: ProcessArgsList, file_weights: FileWeights, cost_limit: Optional[int] = None) -> int:
+    # runs in the dispatcher's workers - only the resulting cost is passed back
+    if cost_limit is not None:
+        return eval_streamed_batch_cost(stream_process_binary_output(args), file_weights, cost_limit)
+    output_xml = capture_process_binary_output(args)
+    if file_weights is None:
+        return eval_replacements_cost(output_xml)
+    documents = output_xml.split(XML_DOCUMENT_PREFIX)[1:]
+    return sum(weight * eval_replacements_cost(doc) for weight, doc in zip(file_weights, documents))
+
+
+def eval_streamed_batch_cost(
+        output_chunks: Generator[bytes, None, None],
+        file_weights: FileWeights,
+        cost_limit: int
+        ) -> int:
+    """Scores the documents as soon as they are complete, and stops reading
+    (killing clang-format) once the cost exceeds cost_limit."""
+    weights = iter(file_weights) if file_weights is not None else itertools.repeat(1)
+    total_cost = 0
+    # starts with the document being received
+    pending_output = bytearray()
+    search_start = 1
+    try:
+        for chunk in output_chunks:
+            pending_output += chunk
+            # a document is complete once the next one starts - look for that in the new bytes only
+            doc_start = 0
+            while True:
+                next_doc_start = pending_output.find(XML_DOCUMENT_PREFIX, search_start)
+                if next_doc_start < 0:
+                    break
+                total_cost += next(weights) * eval_replacements_cost(pending_output[doc_start:next_doc_start])
+                doc_start = next_doc_start
+                search_start = next_doc_start + 1
+            del pending_output[:doc_start]
+            # the next prefix may have been cut in the middle
+            search_start = max(1, len(pending_output) - len(XML_DOCUMENT_PREFIX) + 1)
+            if total_cost > cost_limit:
+                return total_cost
+    finally:
+        output_chunks.close()
+    if pending_output:
+        total_cost += next(weights) * eval_replacements_cost(pending_output)
+    return total_cost
+
 
-    def startElement(self, name: str, attrs: Dict[str, str]):
-        if name == 'replacement':
-            self._started = True
-            self._num_remove = int(attrs.get('length', 0))
-            self._num_insert = 0
+def eval_replacements_cost(replacements_xml: Union[bytes, bytearray]) -> int:
+    total_cost = 0
+    for match in REPLACEMENT_PATTERN.finditer(replacements_xml):
+        num_remove = int(match[1])
+        inserted_text = match[2]
+        # the inserted text is counted in characters - decode it only when needed
+        if inserted_text.isascii() and b'&' not in inserted_text:
+            num_insert = len(inserted_text)
+        else:
+            num_insert = len(html.unescape(inserted_text.decode()))
+        total_cost += num_remove + num_insert
+    return total_cost
 
-    def characters(self, content: str):
-        if self._started:
-            self._num_insert += len(content)
 
-    def endElement(self, name: str):
-        if self._started:
-            self._replacements.append((self._num_remove, self._num_insert))
-            self._started = False
+def measure_clang_format_times(
+        sample_file: str,
+        config: StyleSettings,
+        batch_len: int = 10,
+        repeat: int = 3
+        ) -> Tuple[float, float]:
+    """Returns the estimated clang-format startup time and per-file time, in seconds."""
+    style_arg = '--style=' + inline_clang_format_config(config)
+    def measure_run_time(files: List[str]) -> float:
+        best_time = math.inf
+        for _ in range(repeat):
+            t_start = time.perf_counter()
+            capture_process_binary_output(['clang-format', '--output-replacements-xml', style_arg, *files])
+            best_time = min(best_time, time.perf_counter() - t_start)
+        return best_time
 
-    def get_total_cost(self):
-        return sum(ninsert + nremove for ninsert, nremove in self._replacements)
+    single_time = measure_run_time([sample_file])
+    batch_time = measure_run_time([sample_file] * batch_len)
+    file_time = max(0.0, (batch_time - single_time) / (batch_len - 1))
+    return max(0.0, single_time - file_time), file_time
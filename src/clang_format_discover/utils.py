@@ -1,33 +1,68 @@
 import glob
-import itertools
+import hashlib
 import os
 import os.path
-from typing import Iterable, List, Tuple, TypeVar
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, TypeVar
 
 _T = TypeVar('T')
 
 
-# based on https://stackoverflow.com/a/22045226
-def chunkify(it: Iterable[_T], size: int) -> Iterable[Tuple[_T]]:
-    it = iter(it)
-    return iter(lambda: tuple(itertools.islice(it, size)), ())
-
-
 def ordered_diff(first: Iterable[_T], second: Iterable[_T]) -> List[_T]:
-    return [k for k in first if k not in second]
+    excluded = set(second)
+    return [k for k in first if k not in excluded]
 
 
 def search_files(roots: Iterable[str], extensions: List[str]) -> List[str]:
+    extension_set = frozenset(ext.lower() for ext in extensions)
     def is_valid(filename: str) -> bool:
         _, ext = os.path.splitext(filename)
-        return ext.lower() in extensions
+        return ext.lower() in extension_set
+
+    def expand_root(globspec: str) -> Iterator[str]:
+        for path in glob.glob(globspec, recursive=True):
+            if os.path.isdir(path):
+                yield from walk_files(path, is_valid)
+            elif is_valid(path) and os.path.isfile(path):
+                yield path
+
+    # overlapping roots may reach the same file through differently spelled paths
+    unique_files: Dict[str, str] = {}
+    for globspec in roots:
+        for path in expand_root(globspec):
+            unique_files.setdefault(os.path.normcase(os.path.abspath(path)), path)
+    return list(unique_files.values())
+
 
-    expanded_args = [path for globspec in roots for path in glob.glob(globspec, recursive=True)]
-    file_list = [path for path in expanded_args if os.path.isfile(path)]
-    for files in [walk_files(path) for path in expanded_args if os.path.isdir(path)]:
-        file_list.extend(files)
-    return [path for path in file_list if is_valid(path)]
+def walk_files(dirpath: str, name_filter: Callable[[str], bool]) -> Iterator[str]:
+    # same order as os.walk, but names are filtered before anything is stat'ed
+    pending_dirs = [dirpath]
+    while pending_dirs:
+        subdirs: List[str] = []
+        try:
+            with os.scandir(pending_dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif name_filter(entry.name) and entry.is_file():
+                        yield entry.path
+        except OSError:
+            continue
+        pending_dirs.extend(reversed(subdirs))
 
 
-def walk_files(dirpath: str) -> List[str]:
-    return [os.path.join(root, name) for root, _, files in os.walk(dirpath) for name in files]
+def group_identical_files(file_list: List[str]) -> Tuple[List[str], List[int]]:
+    """Groups files by name and contents. Returns the first file of every group and the group sizes."""
+    # the file name matters too - clang-format uses it to detect the main include
+    group_index: Dict[Tuple[str, bytes], int] = {}
+    unique_files: List[str] = []
+    group_sizes: List[int] = []
+    for path in file_list:
+        with open(path, 'rb') as file:
+            group_key = (os.path.basename(path), hashlib.sha1(file.read()).digest())
+        if group_key in group_index:
+            group_sizes[group_index[group_key]] += 1
+        else:
+            group_index[group_key] = len(unique_files)
+            unique_files.append(path)
+            group_sizes.append(1)
+    return unique_files, group_sizes